@@ -1,15 +1,26 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory, redirect, url_for
+from gevent import monkey
+monkey.patch_all()
+from gevent import get_hub
+
+from flask import Flask, Response, abort, request, jsonify, render_template, send_from_directory, redirect, url_for
 from flask_socketio import SocketIO, emit
+import errno
+import hashlib
 import os
 import requests
+from requests.adapters import HTTPAdapter
+import shutil
 import subprocess
+import tempfile
 import threading
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 import time
-import json
-import re
+import orjson
 from urllib.parse import urlparse
-from werkzeug.utils import secure_filename
+from urllib.request import url2pathname
+from werkzeug.security import safe_join
 import logging
 from datetime import datetime, timedelta
 
@@ -19,6 +30,20 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
+# Let a fronting web server stream files via X-Sendfile instead of Python
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
+class OrjsonCodec:
+    """Drop-in for the json module in Socket.IO packet encoding, backed by orjson"""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        # orjson output is always compact, so stdlib options like separators don't apply
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
 
 # Improved SocketIO configuration
 socketio = SocketIO(
@@ -28,41 +53,204 @@ socketio = SocketIO(
     ping_interval=25,
     logger=False,
     engineio_logger=False,
-    async_mode='threading'
+    async_mode='gevent',  # emits from background tasks are flushed immediately
+    json=OrjsonCodec
 )
 
-UPLOAD_FOLDER = 'uploads'
-HLS_FOLDER = 'hls_output'
+# Folders are made absolute once so ffmpeg, open() and send_from_directory (which
+# resolves relative paths against app.root_path, not the cwd) all agree
+UPLOAD_FOLDER = os.path.abspath(os.environ.get('UPLOAD_FOLDER', 'uploads'))
+# HLS output is ephemeral; pointing this at a tmpfs (e.g. /dev/shm/hls_output)
+# keeps segments in RAM for both the ffmpeg writer and the player reads
+HLS_FOLDER = os.path.abspath(os.environ.get('HLS_FOLDER', 'hls_output'))
+# Conversions are written here and renamed into HLS_FOLDER when done; point it
+# at a tmpfs (e.g. /dev/shm/hls_staging) to keep segment writes off the disk
+HLS_STAGING_FOLDER = os.path.abspath(os.environ.get('HLS_STAGING_FOLDER', 'hls_staging'))
 CHUNK_SIZE = 8192 * 8  # Increased chunk size for better performance
 
+# Resolved once at startup rather than searched for on PATH at every spawn
+FFMPEG_BIN = os.environ.get('FFMPEG_BIN') or shutil.which('ffmpeg') or 'ffmpeg'
+FFPROBE_BIN = os.environ.get('FFPROBE_BIN') or shutil.which('ffprobe') or 'ffprobe'
+
+def env_positive_int(name, default):
+    """Read a positive integer setting from the environment, failing loudly on bad values"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    if not value.strip().isdecimal() or int(value) < 1:
+        raise ValueError(f"Invalid {name} {value!r}, expected a positive integer")
+    return int(value)
+
+def parse_renditions(spec):
+    """Parse "1920x1080:5000k,1280x720:2800k" into [(width, height, bits_per_second), ...]"""
+    renditions = []
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        size, _, bitrate = item.partition(':')
+        width, _, height = size.partition('x')
+        multiplier = {'k': 1000, 'm': 1000000}.get(bitrate[-1:].lower(), 1)
+        if multiplier != 1:
+            bitrate = bitrate[:-1]
+
+        if not (width.isdecimal() and height.isdecimal() and bitrate.isdecimal()):
+            raise ValueError(f"Invalid HLS_RENDITIONS entry {item!r}, expected WIDTHxHEIGHT:BITRATE "
+                             f"(e.g. 1280x720:2800k)")
+        width, height, bitrate = int(width), int(height), int(bitrate) * multiplier
+        if not (width and height and bitrate):
+            raise ValueError(f"Invalid HLS_RENDITIONS entry {item!r}, sizes and bitrate must be non-zero")
+
+        renditions.append((width, height, bitrate))
+    return renditions
+
+# Optional transcoded bitrate ladder, one ffmpeg per rendition run in parallel.
+# Empty (the default) keeps the single stream-copied variant.
+HLS_RENDITIONS = parse_renditions(os.environ.get('HLS_RENDITIONS', ''))
+HLS_AUDIO_BITRATE_FALLBACK = 256000  # Assumed per audio track when ffprobe reports none
+HLS_BANDWIDTH_HEADROOM = 1.1  # Covers rate-control peaks and fMP4 overhead in BANDWIDTH
+
+# Split the CPUs between the conversions expected to run side by side so
+# several ffmpeg processes don't oversubscribe the cores the web server needs.
+# A ladder already runs one all-core libx264 per rendition, so only one at a time.
+MAX_CONCURRENT_CONVERSIONS = env_positive_int('MAX_CONCURRENT_CONVERSIONS',
+                                              1 if HLS_RENDITIONS else max(1, (os.cpu_count() or 1) // 2))
+FFMPEG_THREADS = max(1, (os.cpu_count() or 1) // MAX_CONCURRENT_CONVERSIONS)
+FFMPEG_STDERR_TAIL = 64 * 1024  # Bytes of ffmpeg stderr kept in error messages
+MAX_CONCURRENT_DOWNLOADS = 16
+CLEANUP_INTERVAL = 300  # Seconds between sweeps for expired tasks
+
+# file:// URLs are only accepted for files under this directory (disabled when unset)
+LOCAL_MIRROR_ROOT = os.environ.get('LOCAL_MIRROR_ROOT')
+LOCAL_COPY_SLICE = 8 * 1024 * 1024  # Bytes per sendfile() call for local copies
+# Largest claimed content-length that is reserved on disk before downloading
+# (0 disables preallocation)
+DOWNLOAD_PREALLOCATE_MAX = int(os.environ.get('DOWNLOAD_PREALLOCATE_MAX', 1024 * 1024 * 1024))
+
+HLS_SEGMENT_MAX_AGE = 31536000  # One year; segment files are never rewritten
+HLS_SEGMENT_SECONDS = 10
+
+# Built once rather than per request; every HLS response carries these
+HLS_SEGMENT_CACHE_CONTROL = f'public, max-age={HLS_SEGMENT_MAX_AGE}, immutable'
+HLS_CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET',
+    'Access-Control-Allow-Headers': 'Range',
+}
+
+# Static files written next to every conversion's playlist
+MASTER_PLAYLIST = (
+    b'#EXTM3U\n'
+    b'#EXT-X-STREAM-INF:BANDWIDTH=4500000,SUBTITLES="subs"\n'
+    b'playlist.m3u8\n'
+    b'#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",NAME="default",DEFAULT=YES,AUTOSELECT=YES,URI="playlist_vtt.m3u8"\n'
+)
+FIRST_SUBTITLE_SEGMENT = (
+    b"WEBVTT\n\n"
+    b"00:00.000 --> 00:05.000\n"
+    b"Streaming...\n"
+)
+
+# Image-based subtitle codecs that FFmpeg can't convert to WebVTT
+BITMAP_SUBTITLE_CODECS = {'hdmv_pgs_subtitle', 'dvd_subtitle', 'dvb_subtitle', 'xsub'}
+
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(HLS_FOLDER, exist_ok=True)
+os.makedirs(HLS_STAGING_FOLDER, exist_ok=True)
 
 tasks = {}
+tasks_lock = threading.Lock()  # guards adding/removing tasks and status transitions
+
+# Bounded workers so a burst of requests can't start unlimited downloads or ffmpegs
+download_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS)
+convert_slots = threading.BoundedSemaphore(MAX_CONCURRENT_CONVERSIONS)
 active_connections = set()
 
-# Progress update throttling
-progress_cache = {}
+# ffprobe results keyed by file fingerprint, so fetching the same file again skips the probe
+probe_cache = OrderedDict()
+probe_cache_lock = threading.Lock()
+PROBE_CACHE_SIZE = 512
+PROBE_FINGERPRINT_BYTES = 4096
+
+# Shared session so connections (and TLS) are reused across downloads
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=3)
+http_session.mount('http://', http_adapter)
+http_session.mount('https://', http_adapter)
+# Video is already compressed; ask for the raw bytes so content-length stays accurate
+http_session.headers.update({'Accept-Encoding': 'identity'})
+
+# Progress update throttling, keyed by "<task_id>_<stage>" and bounded as an LRU
+progress_cache = OrderedDict()
+progress_cache_lock = threading.Lock()
+PROGRESS_CACHE_SIZE = 10_000
 PROGRESS_UPDATE_INTERVAL = 1.0  # Minimum seconds between progress updates
 
+# Outgoing events are coalesced and sent to clients as one 'batch' frame
+emit_queue = []
+emit_queue_lock = threading.Lock()
+emit_flush_scheduled = False
+EMIT_BATCH_INTERVAL = 0.05  # Seconds to collect events before flushing
+EMIT_BATCH_MAX = 140  # Flush early once this many events are pending
+
+def queue_emit(event, data):
+    """Queue a server->client event for the next batch frame"""
+    global emit_flush_scheduled
+    events = None
+    schedule_flush = False
+
+    with emit_queue_lock:
+        emit_queue.append({'type': event, 'data': data})
+
+        if len(emit_queue) >= EMIT_BATCH_MAX:
+            events = emit_queue[:]
+            emit_queue.clear()
+        elif not emit_flush_scheduled:
+            # Only one flush is pending per batch; later events just join it
+            emit_flush_scheduled = True
+            schedule_flush = True
+
+    if events:
+        socketio.emit('batch', {'events': events})
+    if schedule_flush:
+        socketio.start_background_task(flush_emit_queue)
+
+def flush_emit_queue():
+    """Send everything queued during the batch window as a single 'batch' event"""
+    global emit_flush_scheduled
+    socketio.sleep(EMIT_BATCH_INTERVAL)
+
+    with emit_queue_lock:
+        events = emit_queue[:]
+        emit_queue.clear()
+        emit_flush_scheduled = False
+
+    if events:
+        socketio.emit('batch', {'events': events})
+
 def throttled_progress_update(task_id, stage, progress, message):
-    """Only send progress updates if enough time has passed"""
-    current_time = time.time()
+    """Only send progress updates if the percentage moved and enough time has passed"""
+    current_time = time.monotonic()
     cache_key = f"{task_id}_{stage}"
 
-    # Check if we should send this update
-    if cache_key in progress_cache:
-        last_update_time, last_progress = progress_cache[cache_key]
+    with progress_cache_lock:
+        # Check if we should send this update
+        if cache_key in progress_cache:
+            last_update_time, last_progress = progress_cache[cache_key]
 
-        # Skip update if less than interval passed and progress change is small
-        if (current_time - last_update_time < PROGRESS_UPDATE_INTERVAL and
-                abs(progress - last_progress) < 5):
-            return
+            # Never resend an unchanged percentage
+            if progress == last_progress:
+                return
 
-    # Update cache and send progress
-    progress_cache[cache_key] = (current_time, progress)
+            # Skip update if less than interval passed and progress change is small
+            if (current_time - last_update_time < PROGRESS_UPDATE_INTERVAL and
+                    abs(progress - last_progress) < 5):
+                return
 
-    socketio.emit('progress_update', {
+        # Update cache and send progress
+        progress_cache[cache_key] = (current_time, progress)
+        progress_cache.move_to_end(cache_key)
+        if len(progress_cache) > PROGRESS_CACHE_SIZE:
+            progress_cache.popitem(last=False)
+
+    queue_emit('progress_update', {
         'task_id': task_id,
         'stage': stage,
         'progress': progress,
@@ -72,32 +260,43 @@ def throttled_progress_update(task_id, stage, progress, message):
 def cleanup_old_tasks():
     """Clean up old completed/failed tasks to prevent memory leaks"""
     current_time = time.time()
-    tasks_to_remove = []
 
-    for task_id, task in tasks.items():
+    # Detach expired tasks under the lock, then delete their files without holding it
+    with tasks_lock:
         # Remove tasks older than 24 hours
-        if current_time - task.get('created_at', 0) > 86400:
-            tasks_to_remove.append(task_id)
-
-            # Clean up files
-            if 'downloaded_file' in task and os.path.exists(task['downloaded_file']):
+        tasks_to_remove = [task_id for task_id, task in tasks.items()
+                           if current_time - task.get('created_at', 0) > 86400]
+        removed_tasks = [(task_id, tasks.pop(task_id)) for task_id in tasks_to_remove]
+
+    # Progress entries are stored per stage, so drop every key for the task
+    if removed_tasks:
+        prefixes = tuple(f"{task_id}_" for task_id, _ in removed_tasks)
+        with progress_cache_lock:
+            for key in [key for key in progress_cache if key.startswith(prefixes)]:
+                del progress_cache[key]
+
+    for task_id, task in removed_tasks:
+
+        # Clean up files; unlink directly instead of stat-ing first
+        for key in ('downloaded_file', 'partial_file'):
+            if key in task:
                 try:
-                    os.remove(task['downloaded_file'])
-                except:
+                    os.unlink(task[key])
+                except OSError:
                     pass
 
-            hls_dir = os.path.join(HLS_FOLDER, task_id)
-            if os.path.exists(hls_dir):
-                try:
-                    import shutil
-                    shutil.rmtree(hls_dir)
-                except:
-                    pass
+        shutil.rmtree(os.path.join(HLS_FOLDER, task_id), ignore_errors=True)
+
+def cleanup_loop():
+    """Periodically expire old tasks in the background, off the request path"""
+    while True:
+        socketio.sleep(CLEANUP_INTERVAL)
+        try:
+            cleanup_old_tasks()
+        except Exception as e:
+            logger.error(f"Task cleanup error: {e}")
 
-    for task_id in tasks_to_remove:
-        del tasks[task_id]
-        if task_id in progress_cache:
-            del progress_cache[task_id]
+socketio.start_background_task(cleanup_loop)
 
 def parse_duration(duration_str):
     """Parse FFmpeg duration string to seconds"""
@@ -110,24 +309,72 @@ def parse_duration(duration_str):
         return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
     return 0
 
+def format_bitrate(bit_rate):
+    """Format an ffprobe bit_rate value for display"""
+    bitrate = int(bit_rate)
+    if bitrate > 1000000:
+        return f"{bitrate/1000000:.1f} Mbps"
+    return f"{bitrate/1000:.0f} kbps"
+
+def probe_cache_key(filepath):
+    """Fingerprint a file by its size and a hash of its first and last few KB"""
+    size = os.path.getsize(filepath)
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        digest.update(f.read(PROBE_FINGERPRINT_BYTES))
+        if size > PROBE_FINGERPRINT_BYTES:
+            f.seek(max(PROBE_FINGERPRINT_BYTES, size - PROBE_FINGERPRINT_BYTES))
+            digest.update(f.read(PROBE_FINGERPRINT_BYTES))
+    return size, digest.hexdigest()
+
 def extract_stream_info(filepath):
+    """Extract stream information, reusing an earlier probe of the same file"""
+    try:
+        cache_key = probe_cache_key(filepath)
+    except OSError:
+        cache_key = None
+
+    if cache_key is not None:
+        with probe_cache_lock:
+            if cache_key in probe_cache:
+                probe_cache.move_to_end(cache_key)
+                return probe_cache[cache_key]
+
+    stream_info = probe_stream_info(filepath)
+
+    if stream_info and cache_key is not None:
+        with probe_cache_lock:
+            probe_cache[cache_key] = stream_info
+            if len(probe_cache) > PROBE_CACHE_SIZE:
+                probe_cache.popitem(last=False)
+
+    return stream_info
+
+def probe_stream_info(filepath):
     """Extract detailed stream information using ffprobe"""
     try:
         cmd = [
-            'ffprobe',
+            FFPROBE_BIN,
             '-v', 'quiet',
+            '-threads', '0',
             '-print_format', 'json',
-            '-show_streams',
-            '-show_format',
+            # Only ask for the fields rendered in the stream picker
+            '-show_entries',
+            'stream=index,codec_type,codec_name,width,height,r_frame_rate,bit_rate,channels,sample_rate'
+            ':stream_disposition=forced,hearing_impaired'
+            ':stream_tags=language,title,BPS'
+            ':format=duration',
             filepath
         ]
 
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        # Keep stdout as bytes; orjson parses them without a separate decode pass.
+        # stderr is discarded: with -v quiet ffprobe writes nothing useful there.
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=30)
         if result.returncode != 0:
-            logger.error(f"ffprobe failed: {result.stderr}")
+            logger.error(f"ffprobe failed with exit code {result.returncode}")
             return None
 
-        data = json.loads(result.stdout)
+        data = orjson.loads(result.stdout)
         streams = data.get('streams', [])
         format_info = data.get('format', {})
 
@@ -138,6 +385,7 @@ def extract_stream_info(filepath):
         for stream in streams:
             codec_type = stream.get('codec_type')
             index = stream.get('index')
+            tags = stream.get('tags') or {}
 
             if codec_type == 'video':
                 video_info = {
@@ -151,19 +399,12 @@ def extract_stream_info(filepath):
 
                 # Extract frame rate
                 if 'r_frame_rate' in stream:
-                    fps_str = stream['r_frame_rate']
-                    if '/' in fps_str and fps_str != '0/0':
-                        num, den = fps_str.split('/')
-                        if int(den) != 0:
-                            video_info['fps'] = f"{int(num)/int(den):.2f}"
+                    num, sep, den = stream['r_frame_rate'].partition('/')
+                    if sep and den != '0':
+                        video_info['fps'] = f"{int(num)/int(den):.2f}"
 
-                # Extract bitrate
                 if 'bit_rate' in stream:
-                    bitrate = int(stream['bit_rate'])
-                    if bitrate > 1000000:
-                        video_info['bitrate'] = f"{bitrate/1000000:.1f} Mbps"
-                    else:
-                        video_info['bitrate'] = f"{bitrate/1000:.0f} kbps"
+                    video_info['bitrate'] = format_bitrate(stream['bit_rate'])
 
                 video_streams.append(video_info)
 
@@ -171,23 +412,19 @@ def extract_stream_info(filepath):
                 audio_info = {
                     'index': index,
                     'codec': stream.get('codec_name', 'unknown'),
-                    'language': None,
-                    'title': None,
+                    'language': tags.get('language'),
+                    'title': tags.get('title'),
                     'channels': stream.get('channels'),
                     'sample_rate': stream.get('sample_rate'),
-                    'bitrate': None
+                    'bitrate': None,
+                    'bitrate_bps': None
                 }
 
-                tags = stream.get('tags', {})
-                if 'language' in tags:
-                    audio_info['language'] = tags['language']
-
-                if 'title' in tags:
-                    audio_info['title'] = tags['title']
-
-                if 'bit_rate' in stream:
-                    bitrate = int(stream['bit_rate'])
-                    audio_info['bitrate'] = f"{bitrate/1000:.0f} kbps"
+                # Matroska only carries the bitrate in the BPS statistics tag
+                bit_rate = stream.get('bit_rate') or tags.get('BPS')
+                if bit_rate:
+                    audio_info['bitrate'] = format_bitrate(bit_rate)
+                    audio_info['bitrate_bps'] = int(bit_rate)
 
                 if audio_info['sample_rate']:
                     audio_info['sample_rate'] = f"{int(audio_info['sample_rate'])/1000:.1f}k"
@@ -198,19 +435,12 @@ def extract_stream_info(filepath):
                 subtitle_info = {
                     'index': index,
                     'codec': stream.get('codec_name', 'unknown'),
-                    'language': None,
-                    'title': None,
+                    'language': tags.get('language'),
+                    'title': tags.get('title'),
                     'forced': False,
                     'hearing_impaired': False
                 }
 
-                tags = stream.get('tags', {})
-                if 'language' in tags:
-                    subtitle_info['language'] = tags['language']
-
-                if 'title' in tags:
-                    subtitle_info['title'] = tags['title']
-
                 disposition = stream.get('disposition', {})
                 subtitle_info['forced'] = disposition.get('forced', 0) == 1
                 subtitle_info['hearing_impaired'] = disposition.get('hearing_impaired', 0) == 1
@@ -231,6 +461,94 @@ def extract_stream_info(filepath):
         logger.error(f"Error extracting stream info: {e}")
         return None
 
+def fetch_http(url, task_id, filepath):
+    """Stream an HTTP(S) URL to filepath, reporting download progress"""
+    # Download with improved error handling and progress
+    try:
+        response = http_session.get(url, stream=True, timeout=30)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        raise Exception(f"Failed to download: {str(e)}")
+
+    # File size comes from the GET itself, no separate HEAD roundtrip
+    total_size = int(response.headers.get('content-length', 0))
+
+    downloaded_size = 0
+    last_progress = -1
+
+    try:
+        with open(filepath, 'wb') as f:
+            # Reserve the whole file up front so the filesystem allocates it in
+            # one go instead of growing it extent by extent on every write.
+            # The size is whatever the origin claims, and glibc falls back to
+            # writing every block where fallocate isn't supported, so only
+            # reserve up to DOWNLOAD_PREALLOCATE_MAX
+            if 0 < total_size <= DOWNLOAD_PREALLOCATE_MAX:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, total_size)
+                except OSError:
+                    pass
+
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                downloaded_size += len(chunk)
+
+                # Only consider an update once the integer percentage moves
+                if total_size > 0:
+                    progress = min(int(downloaded_size * 100 / total_size), 99)
+                    if progress != last_progress:
+                        throttled_progress_update(task_id, 'downloading', progress,
+                                                  f'Downloaded: {downloaded_size // (1024*1024)} MB')
+                        last_progress = progress
+
+            # Drop any reserved space the server didn't actually send
+            f.truncate(downloaded_size)
+    except Exception:
+        # An early close would otherwise leave the whole reservation on disk
+        try:
+            os.unlink(filepath)
+        except FileNotFoundError:
+            pass
+        raise
+
+def copy_local_file(source_path, task_id, filepath):
+    """Copy a file:// source under LOCAL_MIRROR_ROOT to filepath with sendfile(2)"""
+    if not LOCAL_MIRROR_ROOT:
+        raise Exception('Local file URLs are not enabled')
+
+    source_path = os.path.realpath(source_path)
+    mirror_root = os.path.realpath(LOCAL_MIRROR_ROOT)
+    if os.path.commonpath([source_path, mirror_root]) != mirror_root:
+        raise Exception('Local file is outside the allowed mirror directory')
+
+    threadpool = get_hub().threadpool
+
+    try:
+        with open(source_path, 'rb') as src, open(filepath, 'wb') as dst:
+            total_size = os.fstat(src.fileno()).st_size
+            offset = 0
+
+            # os.sendfile isn't monkey-patched, so each slice runs on the hub's
+            # thread pool; called inline it would block every greenlet (and all
+            # websocket traffic) for as long as the mirror takes to read it
+            while offset < total_size:
+                sent = threadpool.apply(os.sendfile, (dst.fileno(), src.fileno(), offset,
+                                                      min(LOCAL_COPY_SLICE, total_size - offset)))
+                if sent == 0:
+                    break
+                offset += sent
+
+                progress = min(int(offset * 100 / total_size), 99)
+                throttled_progress_update(task_id, 'downloading', progress,
+                                          f'Copied: {offset // (1024*1024)} MB')
+    except Exception:
+        # Don't leave a half-copied file behind in the upload folder
+        try:
+            os.unlink(filepath)
+        except FileNotFoundError:
+            pass
+        raise
+
 def download_file(url, task_id):
     try:
         if task_id not in tasks:
@@ -239,43 +557,20 @@ def download_file(url, task_id):
         tasks[task_id]['status'] = 'downloading'
         tasks[task_id]['progress'] = 0
 
-        # Get file size with timeout
-        try:
-            response = requests.head(url, timeout=10)
-            total_size = int(response.headers.get('content-length', 0))
-        except:
-            total_size = 0
-
         parsed_url = urlparse(url)
-        filename = f"{task_id}.mkv"
-        filename = secure_filename(filename)
+        filename = f"{task_id}.mkv"  # task_id is a generated UUID, already a safe name
         filepath = os.path.join(UPLOAD_FOLDER, filename)
 
-        # Download with improved error handling and progress
-        try:
-            response = requests.get(url, stream=True, timeout=30)
-            response.raise_for_status()
-        except requests.RequestException as e:
-            raise Exception(f"Failed to download: {str(e)}")
-
-        downloaded_size = 0
-        last_progress_time = time.time()
+        # Recorded up front so the cleanup sweep finds the file even if the
+        # download dies before it can remove it itself
+        tasks[task_id]['partial_file'] = filepath
 
-        with open(filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                if chunk:
-                    f.write(chunk)
-                    downloaded_size += len(chunk)
-
-                    # Throttled progress updates
-                    current_time = time.time()
-                    if current_time - last_progress_time >= 1.0:  # Update every second
-                        if total_size > 0:
-                            progress = min(int((downloaded_size / total_size) * 100), 99)
-                            throttled_progress_update(task_id, 'downloading', progress,
-                                                      f'Downloaded: {downloaded_size // (1024*1024)} MB')
-                        last_progress_time = current_time
+        if parsed_url.scheme == 'file':
+            copy_local_file(url2pathname(parsed_url.path), task_id, filepath)
+        else:
+            fetch_http(url, task_id, filepath)
 
+        tasks[task_id].pop('partial_file', None)
         tasks[task_id]['downloaded_file'] = filepath
         tasks[task_id]['filename'] = filename
         tasks[task_id]['status'] = 'analyzing'
@@ -288,9 +583,13 @@ def download_file(url, task_id):
 
         if stream_info:
             tasks[task_id]['streams'] = stream_info
+            try:
+                tasks[task_id]['duration'] = float(stream_info['duration'])
+            except (TypeError, ValueError):
+                pass
             tasks[task_id]['status'] = 'ready_for_conversion'
 
-            socketio.emit('download_complete', {
+            queue_emit('download_complete', {
                 'task_id': task_id,
                 'streams': stream_info,
                 'message': 'Download complete. Please select streams to include.'
@@ -302,38 +601,216 @@ def download_file(url, task_id):
         logger.error(f"Download error for task {task_id}: {e}")
         tasks[task_id]['status'] = 'error'
         tasks[task_id]['error'] = str(e)
-        socketio.emit('error', {
+        queue_emit('error', {
             'task_id': task_id,
             'message': f'Download/Analysis error: {str(e)}'
         })
 
-def parse_ffmpeg_progress(line, duration_seconds):
-    """Parse FFmpeg progress from stderr output"""
-    # Look for time= pattern
-    time_match = re.search(r'time=(\d{2}):(\d{2}):(\d{2}\.\d{2})', line)
-    if time_match:
-        hours, minutes, seconds = time_match.groups()
-        current_seconds = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
-
-        if duration_seconds > 0:
-            progress = min(int((current_seconds / duration_seconds) * 100), 99)
-            return progress
-    return None
-
-def generate_first_subtitle_segment(task_id):
-    hls_dir = os.path.join(HLS_FOLDER, task_id)
+def write_bytes(path, data):
+    """Write bytes to path with raw os-level calls (no text-mode layer)"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def generate_first_subtitle_segment(hls_dir):
     playlist_path = os.path.join(hls_dir, 'playlist0.vtt')
+    write_bytes(playlist_path, FIRST_SUBTITLE_SEGMENT)
 
-    content = (
-        "WEBVTT\n\n"
-        "00:00.000 --> 00:05.000\n"
-        "Streaming...\n"
-    )
+def stop_process(process, timeout=5):
+    """Terminate a subprocess that is still running, killing it if it doesn't exit"""
+    if process.poll() is not None:
+        return
+
+    process.terminate()
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
 
-    with open(playlist_path, 'w', encoding='utf-8') as f:
-        f.write(content)
+def publish_hls_dir(staging_dir, hls_dir):
+    """Move a finished HLS directory into place with a single rename"""
+    try:
+        os.rename(staging_dir, hls_dir)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+        # Staging lives on another filesystem (e.g. tmpfs): copy next to the
+        # destination first so the final step is still an atomic rename
+        partial_dir = f'{hls_dir}.partial'
+        shutil.copytree(staging_dir, partial_dir)
+        os.rename(partial_dir, hls_dir)
+        shutil.rmtree(staging_dir)
+
+def build_map_args(task, selected_streams, total_stream_counts):
+    """Build FFmpeg -map arguments for the streams picked in the UI"""
+    map_args = []
+    video_stream_count = total_stream_counts.get('video', 0)
+    audio_stream_count = total_stream_counts.get('audio', 0)
+
+    # Video streams
+    for video_index in selected_streams.get('video', []):
+        map_args.extend(['-map', f'0:v:{video_index}'])
+
+    # Audio streams
+    for audio_index in selected_streams.get('audio', []):
+        map_args.extend(['-map', f'0:a:{audio_index-video_stream_count}'])
+
+    # Subtitle streams (bitmap formats can't be converted to WebVTT, so skip them)
+    subtitle_codecs = {s['index']: s['codec'] for s in task.get('streams', {}).get('subtitle', [])}
+    for subtitle_index in selected_streams.get('subtitle', []):
+        if subtitle_codecs.get(subtitle_index) in BITMAP_SUBTITLE_CODECS:
+            logger.warning(f"Skipping bitmap subtitle stream {subtitle_index} for task {task['id']}")
+            continue
+        map_args.extend(['-map', f'0:s:{subtitle_index-video_stream_count-audio_stream_count}'])
+
+    # If no streams selected, use defaults
+    if not map_args:
+        map_args = ['-map', '0:v', '-map', '0:a?']
+
+    return map_args
+
+def scaled_size(src_width, src_height, box_width, box_height):
+    """Frame size of scale=box_width:box_height:force_original_aspect_ratio=decrease:force_divisible_by=2"""
+    # Same rounding as ffmpeg: nearest for the aspect fit, then down to even
+    width = min(box_width, (box_height * src_width + src_height // 2) // src_height)
+    height = min(box_height, (box_width * src_height + src_width // 2) // src_width)
+    return width - width % 2, height - height % 2
+
+def plan_renditions(task, selected_streams):
+    """Fit HLS_RENDITIONS to this task's source, dropping rungs that would upscale it"""
+    streams = task.get('streams') or {}
+    # build_map_args maps every video and audio stream when nothing was picked
+    picked_any = any(selected_streams.get(kind) for kind in ('video', 'audio', 'subtitle'))
+
+    def mapped(kind):
+        probed = streams.get(kind, [])
+        if not picked_any:
+            return probed
+        wanted = set(selected_streams.get(kind, []))
+        return [stream for stream in probed if stream['index'] in wanted]
+
+    videos = mapped('video')
+    src_width = videos[0].get('width') if videos else None
+    src_height = videos[0].get('height') if videos else None
+
+    # Audio is stream-copied into every variant, so BANDWIDTH has to include it
+    audio_bps = sum(stream.get('bitrate_bps') or HLS_AUDIO_BITRATE_FALLBACK
+                    for stream in mapped('audio'))
+
+    renditions = []
+    for width, height, bitrate in HLS_RENDITIONS:
+        resolution = None
+        if src_width and src_height:
+            resolution = scaled_size(src_width, src_height, width, height)
+            if resolution[0] > src_width or resolution[1] > src_height:
+                continue
+
+        renditions.append({
+            'name': f'{height}p',
+            'width': width,
+            'height': height,
+            'bitrate': bitrate,
+            'resolution': resolution,
+            'bandwidth': int((bitrate + audio_bps) * HLS_BANDWIDTH_HEADROOM)
+        })
+
+    return renditions
+
+def hls_output_args(playlist_file):
+    """FFmpeg HLS muxer options shared by every variant"""
+    return [
+        '-start_number', '0',
+        '-hls_time', str(HLS_SEGMENT_SECONDS),
+        '-hls_list_size', '0',
+        '-hls_flags', 'delete_segments+temp_file+independent_segments',
+        '-hls_segment_type', 'fmp4',
+        '-f', 'hls',
+        playlist_file
+    ]
+
+def run_ffmpeg(ffmpeg_cmd, duration_us, on_progress, processes):
+    """Run one ffmpeg to completion, passing each new percentage to on_progress"""
+    # Read FFmpeg's key=value progress stream from stdout. stderr goes to an
+    # unnamed temp file so a chatty ffmpeg can never block on a full pipe
+    # that nobody is reading.
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(
+            ffmpeg_cmd,
+            stdout=subprocess.PIPE,
+            stderr=stderr_file,
+            encoding='ascii',
+            errors='replace',
+            bufsize=1
+        )
+        # Registered so the caller can stop it if the conversion is abandoned
+        processes.append(process)
+
+        last_progress = -1
+        out_time_us = None
+
+        # Each report is a block of key=value lines closed by progress=continue|end;
+        # remember the position and only do the math once per block
+        for line in iter(process.stdout.readline, ''):
+            key, _, value = line.partition('=')
+            if key == 'out_time_us':
+                out_time_us = value
+                continue
+            if key != 'progress' or duration_us <= 0 or out_time_us is None:
+                continue
+
+            try:
+                # Negative (or AV_NOPTS) timestamps show up before the first packet
+                progress = max(0, min(99, int(out_time_us) * 100 // duration_us))
+            except ValueError:
+                # FFmpeg reports N/A until the first packet is muxed
+                continue
+
+            if progress != last_progress:
+                on_progress(progress)
+                last_progress = progress
+
+        process.wait()
+
+        if process.returncode != 0:
+            # Only the tail matters; a long run can leave megabytes of warnings
+            stderr_size = stderr_file.seek(0, os.SEEK_END)
+            stderr_file.seek(max(0, stderr_size - FFMPEG_STDERR_TAIL))
+            raise Exception(f"FFmpeg error: {stderr_file.read().decode(errors='replace')}")
+
+def run_ffmpeg_parallel(commands, duration_us, on_progress, processes):
+    """Run several ffmpeg commands side by side, reporting the slowest one's progress"""
+    percents = [0] * len(commands)
+
+    def rendition_progress(i):
+        def report(progress):
+            percents[i] = progress
+            on_progress(min(percents))
+        return report
+
+    pool = ThreadPoolExecutor(max_workers=len(commands))
+    try:
+        futures = [
+            pool.submit(run_ffmpeg, cmd, duration_us, rendition_progress(i), processes)
+            for i, cmd in enumerate(commands)
+        ]
+        # Returns as soon as one fails (the caller then stops the others),
+        # otherwise once all of them have finished
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in done:
+            future.result()
+    finally:
+        pool.shutdown(wait=False)
 
 def convert_to_hls(task_id, selected_streams, total_stream_counts):
+    processes = []
+    staging_dir = None
+    holding_slot = False
     try:
         if task_id not in tasks:
             raise Exception('Task not found')
@@ -344,138 +821,147 @@ def convert_to_hls(task_id, selected_streams, total_stream_counts):
         if not input_file or not os.path.exists(input_file):
             raise Exception('Downloaded file not found')
 
+        # Only MAX_CONCURRENT_CONVERSIONS conversions run at once; the rest wait queued
+        if not convert_slots.acquire(blocking=False):
+            throttled_progress_update(task_id, 'queued', 0, 'Waiting for a free conversion slot...')
+            convert_slots.acquire()
+        holding_slot = True
+
         tasks[task_id]['status'] = 'converting'
         tasks[task_id]['progress'] = 0
 
-        hls_dir = os.path.join(HLS_FOLDER, task_id)
-        os.makedirs(hls_dir, exist_ok=True)
-
-        playlist_file = os.path.join(hls_dir, 'playlist.m3u8')
+        # FFmpeg writes into a private staging directory; readers only ever see
+        # the finished output once it is renamed into HLS_FOLDER
+        staging_dir = os.path.join(HLS_STAGING_FOLDER, task_id)
+        os.makedirs(staging_dir, exist_ok=True)
 
         # Build FFmpeg command with selected streams
-        ffmpeg_cmd = ['ffmpeg', '-y', '-i', input_file, '-progress', 'pipe:2']
-
-        # Add stream mappings based on selection
-        map_args = []
-        video_stream_count = total_stream_counts.get('video', 0)
-        audio_stream_count = total_stream_counts.get('audio', 0)
-
-        # Video streams
-        for video_index in selected_streams.get('video', []):
-            map_args.extend(['-map', f'0:v:{video_index}'])
-
-        # Audio streams
-        for audio_index in selected_streams.get('audio', []):
-            map_args.extend(['-map', f'0:a:{audio_index-video_stream_count}'])
-
-        # Subtitle streams
-        for subtitle_index in selected_streams.get('subtitle', []):
-            map_args.extend(['-map', f'0:s:{subtitle_index-video_stream_count-audio_stream_count}'])
-
-        # If no streams selected, use defaults
-        if not map_args:
-            map_args = ['-map', '0:v', '-map', '0:a?']
-
-        ffmpeg_cmd.extend(map_args)
-
-        # Add encoding options
-        ffmpeg_cmd.extend([
-            '-c:v', 'copy',
-            '-c:a', 'copy',
-            '-c:s', 'webvtt',
-            '-start_number', '0',
-            '-hls_time', '10',
-            '-hls_list_size', '0',
-            '-hls_flags', 'delete_segments',
-            '-f', 'hls',
-            playlist_file
-        ])
-
-        # Get video duration for progress calculation
-        duration_seconds = 0
-        if 'streams' in task and 'duration' in task['streams']:
-            try:
-                duration_seconds = float(task['streams']['duration'])
-            except:
-                pass
-
-        # Run conversion with real progress monitoring
-        process = subprocess.Popen(
-            ffmpeg_cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-            bufsize=1
-        )
-
-        last_progress_time = time.time()
+        base_cmd = [
+            FFMPEG_BIN, '-y', '-hwaccel', 'auto', '-i', input_file,
+            '-progress', 'pipe:1', '-nostats', '-loglevel', 'error'
+        ]
+        base_cmd.extend(build_map_args(task, selected_streams, total_stream_counts))
+
+        # Falls back to the stream-copied variant when every rung would upscale
+        renditions = plan_renditions(task, selected_streams) if HLS_RENDITIONS else []
+
+        if renditions:
+            # One independent ffmpeg per rendition. libx264 picks its own thread
+            # count; convert_slots already bounds how many ladders run at once
+            variant_dirs = []
+            commands = []
+
+            for rendition in renditions:
+                width, height, bitrate = rendition['width'], rendition['height'], rendition['bitrate']
+                variant_dir = os.path.join(staging_dir, rendition['name'])
+                os.makedirs(variant_dir, exist_ok=True)
+                variant_dirs.append(variant_dir)
+
+                commands.append(base_cmd + [
+                    '-threads', '0',
+                    '-vf', f'scale={width}:{height}:force_original_aspect_ratio=decrease:force_divisible_by=2',
+                    '-c:v', 'libx264',
+                    '-preset', 'veryfast',
+                    '-b:v', str(bitrate),
+                    '-maxrate', str(bitrate),
+                    '-bufsize', str(bitrate * 2),
+                    # Keyframes on segment boundaries so players can switch renditions cleanly
+                    '-force_key_frames', f'expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})',
+                    '-c:a', 'copy',
+                    '-c:s', 'webvtt',
+                ] + hls_output_args(os.path.join(variant_dir, 'playlist.m3u8')))
+
+            playlist_url = f'/hls/{task_id}/master.m3u8'
+        else:
+            variant_dirs = [staging_dir]
+            commands = [base_cmd + [
+                '-threads', str(FFMPEG_THREADS),
+                '-c:v', 'copy',
+                '-c:a', 'copy',
+                '-c:s', 'webvtt',
+            ] + hls_output_args(os.path.join(staging_dir, 'playlist.m3u8'))]
 
-        # Monitor progress from stderr
-        while True:
-            line = process.stderr.readline()
-            if not line:
-                break
+            playlist_url = f'/hls/{task_id}/playlist.m3u8'
 
-            # Parse progress
-            if duration_seconds > 0:
-                progress = parse_ffmpeg_progress(line, duration_seconds)
-                if progress is not None:
-                    current_time = time.time()
-                    if current_time - last_progress_time >= 1.0:  # Update every second
-                        throttled_progress_update(task_id, 'converting', progress,
-                                                  f'Converting: {progress}%')
-                        last_progress_time = current_time
+        # Get video duration for progress calculation
+        duration_us = 0
+        if 'duration' in task:
+            duration_us = int(task['duration'] * 1_000_000)
 
-        process.wait()
+        def report_progress(progress):
+            throttled_progress_update(task_id, 'converting', progress,
+                                      f'Converting: {progress}%')
 
-        if process.returncode == 0:
-            # Clean up source file
-            if os.path.exists(input_file):
-                os.remove(input_file)
+        if len(commands) == 1:
+            run_ffmpeg(commands[0], duration_us, report_progress, processes)
+        else:
+            run_ffmpeg_parallel(commands, duration_us, report_progress, processes)
 
-            tasks[task_id]['status'] = 'completed'
-            tasks[task_id]['hls_path'] = task_id
-            tasks[task_id]['playlist_url'] = f'/hls/{task_id}/playlist.m3u8'
+        # Clean up source file
+        try:
+            os.unlink(input_file)
+        except FileNotFoundError:
+            pass
 
-            generate_first_subtitle_segment(task_id)
-            generate_master_playlist(task_id)
+        for variant_dir in variant_dirs:
+            generate_first_subtitle_segment(variant_dir)
+        generate_master_playlist(staging_dir, renditions)
+        publish_hls_dir(staging_dir, os.path.join(HLS_FOLDER, task_id))
+        staging_dir = None
 
-            socketio.emit('conversion_complete', {
-                'task_id': task_id,
-                'playlist_url': f'/hls/{task_id}/playlist.m3u8',
-                'message': 'Conversion completed successfully!'
-            })
+        tasks[task_id]['status'] = 'completed'
+        tasks[task_id]['hls_path'] = task_id
+        tasks[task_id]['playlist_url'] = playlist_url
 
-        else:
-            # Get error output
-            _, stderr = process.communicate()
-            raise Exception(f"FFmpeg error: {stderr}")
+        queue_emit('conversion_complete', {
+            'task_id': task_id,
+            'playlist_url': playlist_url,
+            'message': 'Conversion completed successfully!'
+        })
 
     except Exception as e:
         logger.error(f"Conversion error for task {task_id}: {e}")
         tasks[task_id]['status'] = 'error'
         tasks[task_id]['error'] = str(e)
-        socketio.emit('error', {
+        queue_emit('error', {
             'task_id': task_id,
             'message': f'Conversion error: {str(e)}'
         })
 
-def generate_master_playlist(task_id):
-    hls_dir = os.path.join(HLS_FOLDER, task_id)
-    master_path = os.path.join(hls_dir, 'master.m3u8')
+    finally:
+        # Never leave an orphaned ffmpeg behind if this task dies mid-conversion
+        for process in processes:
+            stop_process(process)
 
-    bandwidth = 4500000
+        # Only set while the output hasn't been published
+        if staging_dir is not None:
+            shutil.rmtree(staging_dir, ignore_errors=True)
 
-    content = (
-        '#EXTM3U\n'
-        f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},SUBTITLES="subs"\n'
-        'playlist.m3u8\n'
-        '#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",NAME="default",DEFAULT=YES,AUTOSELECT=YES,URI="playlist_vtt.m3u8"\n'
-    )
+        if holding_slot:
+            convert_slots.release()
 
-    with open(master_path, 'w', encoding='utf-8') as f:
-        f.write(content)
+def generate_master_playlist(hls_dir, renditions=None):
+    master_path = os.path.join(hls_dir, 'master.m3u8')
 
+    if not renditions:
+        write_bytes(master_path, MASTER_PLAYLIST)
+        return master_path
+
+    # One variant per rendition; subtitles come from the first rendition's copy
+    lines = [
+        '#EXTM3U',
+        f'#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",NAME="default",DEFAULT=YES,AUTOSELECT=YES,'
+        f'URI="{renditions[0]["name"]}/playlist_vtt.m3u8"'
+    ]
+    for rendition in renditions:
+        attributes = f'BANDWIDTH={rendition["bandwidth"]}'
+        # Left out when the source size is unknown rather than guessed
+        if rendition['resolution']:
+            attributes += ',RESOLUTION={}x{}'.format(*rendition['resolution'])
+        lines.append(f'#EXT-X-STREAM-INF:{attributes},SUBTITLES="subs"')
+        lines.append(f'{rendition["name"]}/playlist.m3u8')
+
+    write_bytes(master_path, ('\n'.join(lines) + '\n').encode())
     return master_path
 
 # Routes remain the same but with better error handling
@@ -500,22 +986,18 @@ def download_video():
         if not url:
             return jsonify({'error': 'No URL provided'}), 400
 
-        # Clean up old tasks before creating new one
-        cleanup_old_tasks()
-
         task_id = str(uuid.uuid4())
 
-        tasks[task_id] = {
-            'id': task_id,
-            'url': url,
-            'status': 'pending',
-            'progress': 0,
-            'created_at': time.time()
-        }
+        with tasks_lock:
+            tasks[task_id] = {
+                'id': task_id,
+                'url': url,
+                'status': 'pending',
+                'progress': 0,
+                'created_at': time.time()
+            }
 
-        thread = threading.Thread(target=download_file, args=(url, task_id))
-        thread.daemon = True
-        thread.start()
+        download_pool.submit(download_file, url, task_id)
 
         return jsonify({'task_id': task_id})
 
@@ -534,15 +1016,17 @@ def convert_video():
         if not task_id:
             return jsonify({'error': 'No task ID provided'}), 400
 
-        if task_id not in tasks:
-            return jsonify({'error': 'Task not found'}), 404
+        # Check and claim the task atomically so a double submit can't start two conversions
+        with tasks_lock:
+            if task_id not in tasks:
+                return jsonify({'error': 'Task not found'}), 404
 
-        if tasks[task_id]['status'] != 'ready_for_conversion':
-            return jsonify({'error': 'Task not ready for conversion'}), 400
+            if tasks[task_id]['status'] != 'ready_for_conversion':
+                return jsonify({'error': 'Task not ready for conversion'}), 400
 
-        thread = threading.Thread(target=convert_to_hls, args=(task_id, selected_streams, total_stream_counts))
-        thread.daemon = True
-        thread.start()
+            tasks[task_id]['status'] = 'queued'
+
+        socketio.start_background_task(convert_to_hls, task_id, selected_streams, total_stream_counts)
 
         return jsonify({'success': True})
 
@@ -558,13 +1042,27 @@ def get_status(task_id):
 
 @app.route('/hls/<task_id>/<path:filename>')
 def serve_hls(task_id, filename):
-    hls_dir = os.path.join(HLS_FOLDER, task_id)
-    response = send_from_directory(hls_dir, filename)
+    if filename.endswith('.m3u8'):
+        # Playlists are tiny: read them whole so headers and body go out as a
+        # single buffered write instead of a streamed file response
+        playlist_path = safe_join(HLS_FOLDER, task_id, filename)
+        if playlist_path is None or not os.path.isfile(playlist_path):
+            abort(404)
+
+        with open(playlist_path, 'rb') as f:
+            response = Response(f.read(), mimetype='application/vnd.apple.mpegurl')
+
+        # No validators on this response, so ask players to refetch every time
+        response.headers['Cache-Control'] = 'no-cache'
+    else:
+        hls_dir = os.path.join(HLS_FOLDER, task_id)
+        response = send_from_directory(hls_dir, filename)
+
+        # Segments never change once written
+        response.headers['Cache-Control'] = HLS_SEGMENT_CACHE_CONTROL
 
     # Add CORS headers for HLS
-    response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Methods'] = 'GET'
-    response.headers['Access-Control-Allow-Headers'] = 'Range'
+    response.headers.update(HLS_CORS_HEADERS)
 
     return response
 